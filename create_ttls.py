@@ -1,18 +1,32 @@
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import hashlib
+import jinja2
 import rich
 import os
+import time
 import requests
+from requests.adapters import HTTPAdapter
+import requests_cache
 import pandas as pd
 
 
-def get_erddap_metadata(erddap_url: str) -> pd.DataFrame:
+def get_erddap_metadata(session: requests.Session, erddap_url: str, cache_folder: str = ".",
+                        max_age: float = 3600) -> pd.DataFrame:
     """
     Downloads metadata for all datasets from an ERDDAP server and returns a pandas DataFrame.
 
     Parameters
     ----------
+    session : requests.Session
+        HTTP session used to perform the request (e.g. a cached session)
     erddap_url : str
         The base URL of the ERDDAP server (e.g., "https://coastwatch.pfeg.noaa.gov/erddap")
+    cache_folder : str
+        Folder where the dataset list is stored as Parquet, one file per server. Set to None to disable
+    max_age : float
+        Seconds after which the cached dataset list is downloaded again
 
     Returns
     -------
@@ -22,30 +36,42 @@ def get_erddap_metadata(erddap_url: str) -> pd.DataFrame:
     # Ensure URL does not end with a slash
     erddap_url = erddap_url.rstrip("/")
 
-    # ERDDAP provides a CSV table of all datasets at this endpoint
-    metadata_url = f"{erddap_url}/info/index.csv"
+    cache_file = None
+    if cache_folder:
+        url_hash = hashlib.sha1(erddap_url.encode()).hexdigest()[:12]
+        cache_file = os.path.join(cache_folder, f"erddap_index_{url_hash}.parquet")
+        if os.path.exists(cache_file) and time.time() - os.path.getmtime(cache_file) < max_age:
+            return pd.read_parquet(cache_file, engine="pyarrow")
+
+    # ERDDAP provides a JSON table of all datasets at this endpoint
+    metadata_url = f"{erddap_url}/info/index.json"
 
     try:
-        response = requests.get(metadata_url, timeout=30)
+        response = session.get(metadata_url, timeout=30)
         response.raise_for_status()
     except requests.RequestException as e:
         raise RuntimeError(f"Failed to fetch metadata from ERDDAP: {e}")
 
-    # Read the CSV into a DataFrame
-    with open("index.csv", "w") as f:
-        f.write(response.text)
-    df = pd.read_csv("index.csv")
+    # Build the DataFrame straight from the JSON table, skipping CSV tokenization and type inference
+    table = response.json()["table"]
+    df = pd.DataFrame(table["rows"], columns=table["columnNames"])
+    if cache_file:
+        df.to_parquet(cache_file, engine="pyarrow")
     return df
 
 
-def get_dataset_metadata(erddap_url: str, dataset_id) -> pd.DataFrame:
+def get_dataset_metadata(session: requests.Session, erddap_url: str, dataset_id) -> pd.DataFrame:
     """
     Downloads metadata for all datasets from an ERDDAP server and returns a pandas DataFrame.
 
     Parameters
     ----------
+    session : requests.Session
+        HTTP session used to perform the request, can be shared across threads
     erddap_url : str
         The base URL of the ERDDAP server (e.g., "https://coastwatch.pfeg.noaa.gov/erddap")
+    dataset_id : str
+        The ID of the dataset
 
     Returns
     -------
@@ -55,19 +81,18 @@ def get_dataset_metadata(erddap_url: str, dataset_id) -> pd.DataFrame:
     # Ensure URL does not end with a slash
     erddap_url = erddap_url.rstrip("/")
 
-    # ERDDAP provides a CSV table of all datasets at this endpoint
-    metadata_url = f"{erddap_url}/info/{dataset_id}/index.csv"
+    # ERDDAP provides a JSON table of all datasets at this endpoint
+    metadata_url = f"{erddap_url}/info/{dataset_id}/index.json"
 
     try:
-        response = requests.get(metadata_url, timeout=30)
+        response = session.get(metadata_url, timeout=30)
         response.raise_for_status()
     except requests.RequestException as e:
         raise RuntimeError(f"Failed to fetch metadata from ERDDAP: {e}")
 
-    # Read the CSV into a DataFrame
-    with open("index.csv", "w") as f:
-        f.write(response.text)
-    df = pd.read_csv("index.csv")
+    # Build the DataFrame straight from the JSON table, skipping CSV tokenization and type inference
+    table = response.json()["table"]
+    df = pd.DataFrame(table["rows"], columns=table["columnNames"])
     return df
 
 
@@ -124,69 +149,8 @@ def rf_ttl(rf_name, rf_description, folder):
         f.write(contents)
 
 
-def ttl_from_erddap(df, dataset_id, converter_url, folder):
-    ttl_file = os.path.join(folder, dataset_id  + ".ttl")
-    institution = df.loc[df["Attribute Name"] == "institution"]["Value"].values[0]
-    title = df.loc[df["Attribute Name"] == "title"]["Value"].values[0]
-    description = df.loc[df["Attribute Name"] == "summary"]["Value"].values[0]
-    license_uri = df.loc[df["Attribute Name"] == "license_uri"]["Value"].values[0]
-    keywords = df.loc[df["Attribute Name"] == "keywords"]["Value"].values[0]
-    start_time = df.loc[df["Attribute Name"] == "time_coverage_start"]["Value"].values[0]
-    lat = df.loc[df["Attribute Name"] == "geospatial_lat_max"]["Value"].values[0]
-    lon = df.loc[df["Attribute Name"] == "geospatial_lon_max"]["Value"].values[0]
-
-    try:
-        rf_name = df.loc[df["Attribute Name"] == "emso_facility"]["Value"].values[0]
-    except Exception as e:
-        # trying to guess manually the RF
-        if "azores" in dataset_id.lower():
-            rf_name = "AZORES"
-        elif "smartbay" in dataset_id.lower():
-            rf_name = "SmartBay"
-        else:
-            raise e
-
-    rf_name = rf_name.replace(" ", "_")
-    rf_ttl(rf_name, f"{rf_name} EMSO regional racility", folder)
-
-    if not title:
-        rich.print(f"[red]No title for {dataset_id}")
-        rich.print(f"[red]No description for {description}")
-        return
-
-    now = pd.Timestamp.now(tz="utc").strftime("%Y-%m-%dT%H:%M:%SZ")
-
-    dft = df.loc[df["Variable Name"] == "time"]
-    time_range = dft[dft["Attribute Name"] == "actual_range"]["Value"].values[0]
-    tmin_erddap, tmax_erddap = time_range.split(", ")
-
-    # Get a list of variables with standard name, discard all QCs
-    variables = df.loc[df["Attribute Name"] == "standard_name"]["Variable Name"].unique()
-    variables = [v for v in variables if not v.endswith("_QC")]
-    variable_str = ",".join(variables)
-
-
-
-    def erddap_time_to_timestamp(time_str):
-        """ Converts something like 1.2436218E9 into a proper timestamp"""
-        if time_str.lower() == "nan":
-            return pd.Timestamp.now(tz="utc")        
-        number, exponent = time_str.split("E")
-        epoch = float(number) * 10**(float(exponent))
-        return pd.to_datetime(epoch, unit="s")
-
-    tmin_t = erddap_time_to_timestamp(tmin_erddap)
-    tmax_t = erddap_time_to_timestamp(tmax_erddap)
-
-    tmin_str = tmin_t.strftime("%Y-%m-%dT%H:%M:%SZ")
-    tmax_str = tmax_t.strftime("%Y-%m-%dT%H:%M:%SZ")
-    default_min = (tmax_t - pd.to_timedelta("60d")).strftime("%Y-%m-%dT%H:%M:%SZ")
-    default_max = tmax_t.strftime("%Y-%m-%dT%H:%M:%SZ")
-
-    query_url = f"{converter_url}/{dataset_id}?{variable_str}" + "{&time<,time>}"
-
-
-    contents = f"""
+# Dataset TTL template, compiled only once at import time and rendered for every dataset
+TTL_TEMPLATE = jinja2.Environment(autoescape=False, trim_blocks=True).from_string(r"""
 @prefix adms: <http://www.w3.org/ns/adms#> .
 @prefix dash: <http://datashapes.org/dash#> .
 @prefix dc: <http://purl.org/dc/elements/1.1/> .
@@ -217,33 +181,33 @@ def ttl_from_erddap(df, dataset_id, converter_url, folder):
 #contact not found
 
 #---Organization---
-<{dataset_id}_organization> a schema:Organization;
+<{{ dataset_id }}_organization> a schema:Organization;
   schema:identifier [ a schema:PropertyValue;
    schema:propertyID "generic";
-   schema:value "{dataset_id}_organization";
+   schema:value "{{ dataset_id }}_organization";
   ];
-  schema:legalName "{institution}" ;
+  schema:legalName "{{ institution }}" ;
 #institution reference not found
  .
 
 #---Dataset---
-<{dataset_id}_COVJSON> a dcat:Dataset;
-  dct:identifier "{dataset_id}_COVJSON";
-  dct:created "{now}"^^xsd:date;
-  dct:modified "{now}"^^xsd:date;
-  dct:publisher <{dataset_id}_organization>;
-  dcat:keyword "{dataset_id}";
-  dct:description "{description}";
+<{{ dataset_id }}_COVJSON> a dcat:Dataset;
+  dct:identifier "{{ dataset_id }}_COVJSON";
+  dct:created "{{ now }}"^^xsd:date;
+  dct:modified "{{ now }}"^^xsd:date;
+  dct:publisher <{{ dataset_id }}_organization>;
+  dcat:keyword "{{ dataset_id }}";
+  dct:description "{{ description }}";
   dct:temporal [ a dct:PeriodOfTime;
-   schema:startDate "{tmin_str}"^^xsd:dateTime;
+   schema:startDate "{{ tmin_str }}"^^xsd:dateTime;
   ];
   dct:spatial [ a dct:Location;
-   locn:geometry "POINT({lon} {lat})"^^gsp:wktLiteral;
+   locn:geometry "POINT({{ lon }} {{ lat }})"^^gsp:wktLiteral;
   ];
-  dct:title "{title}";
-  dcat:theme  <category:{rf_name}_conc> ;
+  dct:title "{{ title }}";
+  dcat:theme  <category:{{ rf_name }}_conc> ;
   dct:type "http://purl.org/dc/dcmitype/Collection"^^xsd:anyURI ;
-  dcat:distribution <{dataset_id}_distribution_COVJSON>;
+  dcat:distribution <{{ dataset_id }}_distribution_COVJSON>;
 #doi not found
 #update interval not found
 #time coverage end not found
@@ -251,56 +215,56 @@ def ttl_from_erddap(df, dataset_id, converter_url, folder):
   .
 
 #---Distribution---
-<{dataset_id}_distribution_COVJSON> a dcat:Distribution;
-  dct:identifier "{dataset_id}_distribution_COVJSON";
-  dct:issued "{now}"^^xsd:date;
-  dct:modified "{now}"^^xsd:date;
+<{{ dataset_id }}_distribution_COVJSON> a dcat:Distribution;
+  dct:identifier "{{ dataset_id }}_distribution_COVJSON";
+  dct:issued "{{ now }}"^^xsd:date;
+  dct:modified "{{ now }}"^^xsd:date;
   dct:license "https://spdx.org/licenses/CC-BY-4.0"^^xsd:anyURI;
-  dct:description "{description}";
-  dct:title "{title}";
+  dct:description "{{ description }}";
+  dct:title "{{ title }}";
   dct:type "http://publications.europa.eu/resource/authority/distribution-type/WEB_SERVICE"^^xsd:anyURI;
-  dct:conformsTo <{dataset_id}_webservice_COVJSON>;
-  dcat:accessURL <{dataset_id}_operation_COVJSON> ;
+  dct:conformsTo <{{ dataset_id }}_webservice_COVJSON>;
+  dcat:accessURL <{{ dataset_id }}_operation_COVJSON> ;
 .
 
 #---WebService---
-<{dataset_id}_webservice_COVJSON> a epos:WebService;
-  schema:identifier "{dataset_id}_webservice_COVJSON";
-  schema:datePublished "{now}"^^xsd:date;
-  schema:dateModified "{now}"^^xsd:date;
-  schema:provider <{dataset_id}_organization>;
-  schema:keywords "{keywords}";
-  dct:license "{license_uri}"^^xsd:anyURI;
+<{{ dataset_id }}_webservice_COVJSON> a epos:WebService;
+  schema:identifier "{{ dataset_id }}_webservice_COVJSON";
+  schema:datePublished "{{ now }}"^^xsd:date;
+  schema:dateModified "{{ now }}"^^xsd:date;
+  schema:provider <{{ dataset_id }}_organization>;
+  schema:keywords "{{ keywords }}";
+  dct:license "{{ license_uri }}"^^xsd:anyURI;
   dct:temporal [ a dct:PeriodOfTime;
-   schema:startDate "{start_time}"^^xsd:dateTime;
+   schema:startDate "{{ start_time }}"^^xsd:dateTime;
  ];
-  schema:name "{title}";
-  schema:description "{description}";
-  hydra:supportedOperation <{dataset_id}_operation_COVJSON> ;
-  dct:conformsTo <{dataset_id}_APIDocumentation_COVJSON> ;
+  schema:name "{{ title }}";
+  schema:description "{{ description }}";
+  hydra:supportedOperation <{{ dataset_id }}_operation_COVJSON> ;
+  dct:conformsTo <{{ dataset_id }}_APIDocumentation_COVJSON> ;
 .
 
 #---ApiDocumentation---
-<{dataset_id}_APIDocumentation_COVJSON> a hydra:ApiDocumentation;
+<{{ dataset_id }}_APIDocumentation_COVJSON> a hydra:ApiDocumentation;
   hydra:title "web service documentation" ;
       hydra:description "Brief description of the ISGI web service" ;
   hydra:entrypoint "https://erddap.emso.eu/erddap/rest.html"^^xsd:anyURI;
 .
 
 #---Operation---
-<{dataset_id}_operation_COVJSON> a hydra:Operation;
+<{{ dataset_id }}_operation_COVJSON> a hydra:Operation;
   hydra:method "GET"^^xsd:string;
   hydra:returns "covjson";
   hydra:property[ a hydra:IriTemplate;
-   hydra:template "{query_url}"^^xsd:string;
+   hydra:template "{{ query_url }}"^^xsd:string;
        hydra:mapping[ a hydra:IriTemplateMapping;
           hydra:variable "time<"^^xsd:string;
           hydra:property "schema:endDate";
           schema:valuePattern "YYYY-MM-DDThh:mm:ssZ";
           rdfs:range "xsd:dateTime";
           rdfs:label "End time";
-          schema:maxValue "{tmax_str}";
-          schema:defaultValue "{default_max}";
+          schema:maxValue "{{ tmax_str }}";
+          schema:defaultValue "{{ default_max }}";
         ];
 
        hydra:mapping[ a hydra:IriTemplateMapping;
@@ -309,18 +273,123 @@ def ttl_from_erddap(df, dataset_id, converter_url, folder):
           schema:valuePattern "YYYY-MM-DDThh:mm:ssZ";
           rdfs:range "xsd:dateTime";
           rdfs:label "Start time";
-          schema:minValue "{tmin_str}";
-          schema:defaultValue "{default_min}";
+          schema:minValue "{{ tmin_str }}";
+          schema:defaultValue "{{ default_min }}";
         ];
         
         #---- ADD VARIABLES HERE
         
     ];
 .
+    """)
+
+
+# (Variable Name, Attribute Name) pairs that must be present in the dataset metadata to create its TTL
+REQUIRED_ATTRIBUTES = [
+    ("NC_GLOBAL", "institution"),
+    ("NC_GLOBAL", "title"),
+    ("NC_GLOBAL", "summary"),
+    ("NC_GLOBAL", "license_uri"),
+    ("NC_GLOBAL", "keywords"),
+    ("NC_GLOBAL", "time_coverage_start"),
+    ("NC_GLOBAL", "geospatial_lat_max"),
+    ("NC_GLOBAL", "geospatial_lon_max"),
+    ("time", "actual_range"),
+]
+
+
+def ttl_from_erddap(df, dataset_id, converter_url, folder) -> bool:
+    """
+    Creates the TTL file of a dataset from its ERDDAP metadata, returns True if the file has been created
     """
+    ttl_file = os.path.join(folder, dataset_id  + ".ttl")
+    # Build a (Variable Name, Attribute Name) -> Value lookup once instead of filtering the DataFrame every time
+    attrs = dict(zip(zip(df["Variable Name"], df["Attribute Name"]), df["Value"]))
+    missing = [f"{var}:{attr}" for var, attr in REQUIRED_ATTRIBUTES if (var, attr) not in attrs]
+    if missing:
+        rich.print(f"[red]Error processing {dataset_id}: missing attributes {', '.join(missing)}")
+        return False
+
+    institution = attrs[("NC_GLOBAL", "institution")]
+    title = attrs[("NC_GLOBAL", "title")]
+    description = attrs[("NC_GLOBAL", "summary")]
+    license_uri = attrs[("NC_GLOBAL", "license_uri")]
+    keywords = attrs[("NC_GLOBAL", "keywords")]
+    start_time = attrs[("NC_GLOBAL", "time_coverage_start")]
+    lat = attrs[("NC_GLOBAL", "geospatial_lat_max")]
+    lon = attrs[("NC_GLOBAL", "geospatial_lon_max")]
+
+    if ("NC_GLOBAL", "emso_facility") in attrs:
+        rf_name = attrs[("NC_GLOBAL", "emso_facility")]
+    # trying to guess manually the RF
+    elif "azores" in dataset_id.lower():
+        rf_name = "AZORES"
+    elif "smartbay" in dataset_id.lower():
+        rf_name = "SmartBay"
+    else:
+        rich.print(f"[red]Error processing {dataset_id}: missing attribute NC_GLOBAL:emso_facility")
+        return False
 
-    with open(ttl_file, "w") as f:
-        f.write(contents)
+    rf_name = rf_name.replace(" ", "_")
+    rf_ttl(rf_name, f"{rf_name} EMSO regional racility", folder)
+
+    if not title:
+        rich.print(f"[red]No title for {dataset_id}")
+        rich.print(f"[red]No description for {description}")
+        return False
+
+    now = pd.Timestamp.now(tz="utc").strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    time_range = attrs[("time", "actual_range")]
+    tmin_erddap, tmax_erddap = time_range.split(", ")
+
+    # Get a list of variables with standard name, discard all QCs
+    variables = df.loc[df["Attribute Name"] == "standard_name", "Variable Name"].unique()
+    variables = [v for v in variables if not v.endswith("_QC")]
+    variable_str = ",".join(variables)
+
+
+
+    def erddap_time_to_timestamp(time_str):
+        """ Converts something like 1.2436218E9 into a proper timestamp"""
+        if time_str.lower() == "nan":
+            return pd.Timestamp.now(tz="utc")        
+        number, exponent = time_str.split("E")
+        epoch = float(number) * 10**(float(exponent))
+        return pd.to_datetime(epoch, unit="s")
+
+    tmin_t = erddap_time_to_timestamp(tmin_erddap)
+    tmax_t = erddap_time_to_timestamp(tmax_erddap)
+
+    tmin_str = tmin_t.strftime("%Y-%m-%dT%H:%M:%SZ")
+    tmax_str = tmax_t.strftime("%Y-%m-%dT%H:%M:%SZ")
+    default_min = (tmax_t - pd.to_timedelta("60d")).strftime("%Y-%m-%dT%H:%M:%SZ")
+    default_max = tmax_t.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    query_url = f"{converter_url}/{dataset_id}?{variable_str}" + "{&time<,time>}"
+
+
+    contents = TTL_TEMPLATE.render(
+        dataset_id=dataset_id,
+        institution=institution,
+        now=now,
+        description=description,
+        tmin_str=tmin_str,
+        lon=lon,
+        lat=lat,
+        title=title,
+        rf_name=rf_name,
+        keywords=keywords,
+        license_uri=license_uri,
+        start_time=start_time,
+        query_url=query_url,
+        tmax_str=tmax_str,
+        default_max=default_max,
+        default_min=default_min,
+    )
+
+    Path(ttl_file).write_text(contents)
+    return True
 
 
 if __name__ == "__main__":
@@ -333,28 +402,33 @@ if __name__ == "__main__":
 
 
     url = "https://erddap.emso.eu/erddap"
-    datasets = get_erddap_metadata(args.erddap)
-
-    processed = 0
-    os.makedirs(args.output, exist_ok=True)
 
-    for _, row in datasets.iterrows():
-        dataset_id = row["Dataset ID"]
+    # Share a single session (and its connection pool) across all the worker threads. Responses are cached on
+    # disk and revalidated with conditional requests, so unchanged metadata is not downloaded again
+    session = requests_cache.CachedSession("erddap_cache.sqlite", expire_after=3600, cache_control=True)
+    adapter = HTTPAdapter(pool_connections=64, pool_maxsize=64)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
 
-        if pd.isnull(row["tabledap"]) or dataset_id == "allDatasets":
-            rich.print(f"[grey42]Skipping {dataset_id}, not tabledap")
-            continue
+    datasets = get_erddap_metadata(session, args.erddap)
 
-        rich.print(f"Processing dataset [blue]'{dataset_id}'[/blue] ...", end="")
-        df = get_dataset_metadata(url, dataset_id)
-
-        try:
-            ttl_from_erddap(df, dataset_id, args.url, args.output)
-            rich.print(f"[green]success")
-        except IndexError or ValueError or KeyError as e:
-            rich.print(f"[red]Error processing {dataset_id}: {e.__repr__()}")
+    os.makedirs(args.output, exist_ok=True)
 
-        processed += 1
-        if processed > args.limit:
-            exit()
-            
\ No newline at end of file
+    # Select the tabledap datasets at once, empty fields are returned as empty strings in JSON
+    tabledap = datasets["tabledap"].fillna("").astype(bool) & (datasets["Dataset ID"] != "allDatasets")
+    for dataset_id in datasets.loc[~tabledap, "Dataset ID"].tolist():
+        rich.print(f"[grey42]Skipping {dataset_id}, not tabledap")
+    ids = datasets.loc[tabledap, "Dataset ID"].tolist()[:args.limit]
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        futures = {executor.submit(get_dataset_metadata, session, url, dataset_id): dataset_id for dataset_id in ids}
+
+        for future in as_completed(futures):
+            dataset_id = futures[future]
+            rich.print(f"Processing dataset [blue]'{dataset_id}'[/blue] ...", end="")
+            try:
+                df = future.result()
+                if ttl_from_erddap(df, dataset_id, args.url, args.output):
+                    rich.print(f"[green]success")
+            except (RuntimeError, IndexError, ValueError, KeyError) as e:
+                rich.print(f"[red]Error processing {dataset_id}: {e.__repr__()}")
@@ -2,13 +2,19 @@ from argparse import ArgumentParser
 import yaml
 from flask import Flask, request, Response
 from flask_cors import CORS
-import json
+import orjson
 import logging
 import erddapy
+import numpy as np
 import pandas as pd
+import pyarrow
+import pyarrow.csv
+import csv
 from logging.handlers import TimedRotatingFileHandler
 import rich
 import requests
+from requests.adapters import HTTPAdapter
+import requests_cache
 import threading
 import psutil
 import os
@@ -16,16 +22,33 @@ import time
 
 app = Flask(__name__)
 CORS(app)
+log = logging.getLogger(__name__)
 
 def dataframe_to_covjson(df: pd.DataFrame, metadata: dict):
-    df = df.drop_duplicates(subset=["time"])
-    rich.print(df)
-    rich.print(metadata)
+    # Parse time first so that deduplication hashes datetime64 values instead of python objects
+    df = df.assign(time=pd.to_datetime(df["time"], utc=True, format="ISO8601"))
+    # Rows without time can't be placed in the time axis (and NaT can't be serialized)
+    df = df[df["time"].notna()].drop_duplicates(subset=["time"], keep="first")
+    log.debug("df shape=%s", df.shape)
+    if log.isEnabledFor(logging.DEBUG):
+        rich.print(df.head())
 
     param_names = [p for p in metadata.keys() if p not in ["time", "latitude", "longitude"]]
 
     lat = df["latitude"].mean()
     lon = df["longitude"].mean()
+    n = len(df)
+    # Keep the time axis as a naive UTC datetime64 array, orjson formats it as YYYY-MM-DDThh:mm:ssZ (see
+    # JSON_OPTIONS) without building any python strings
+    times = df["time"].to_numpy(dtype="datetime64[s]")
+
+    # Extract all the float parameters in a single copy, transposed so that every parameter is a contiguous row
+    # that orjson can serialize natively. Observations don't need double precision, float32 values are printed
+    # with fewer digits, making the response significantly smaller. Integer parameters are kept exact and
+    # non-numeric parameters (e.g. sensor ids) are kept as they are
+    float_names = [p for p in param_names if pd.api.types.is_float_dtype(df[p])]
+    arr = np.ascontiguousarray(df[float_names].to_numpy(dtype=np.float32).T)
+    float_values = dict(zip(float_names, arr))
 
     parameters = {}
     ranges = {}
@@ -43,12 +66,27 @@ def dataframe_to_covjson(df: pd.DataFrame, metadata: dict):
 
         }
 
+        if name in float_values:
+            data_type, values = "float", float_values[name]
+        elif pd.api.types.is_integer_dtype(df[name]):
+            data_type = "integer"
+            if df[name].hasnans:
+                values = df[name].to_numpy(dtype=object, na_value=None)
+            else:
+                values = df[name].to_numpy(dtype=np.uint64 if df[name].dtype.kind == "u" else np.int64)
+        elif pd.api.types.is_datetime64_any_dtype(df[name]):
+            # Timestamps are not JSON serializable, publish them as ISO strings
+            data_type = "string"
+            values = pd.to_datetime(df[name], utc=True).dt.strftime("%Y-%m-%dT%H:%M:%SZ").to_numpy()
+        else:
+            data_type, values = "string", df[name].to_numpy()
+
         ranges[name] = {
             "type": "NdArray",
-            "dataType": "float",
+            "dataType": data_type,
             "axisNames": ["t"],
-            "shape": [len(df)],
-            "values": df[name].to_list()
+            "shape": [n],
+            "values": values
         }
 
     covjson = {
@@ -57,7 +95,7 @@ def dataframe_to_covjson(df: pd.DataFrame, metadata: dict):
             "type": "Domain",
             "domainType": "PointSeries",
             "axes": {
-                "t": {"values": df["time"].to_list()},
+                "t": {"values": times},
                 "x": {"values": [lon]},
                 "y": {"values": [lat]}
             },
@@ -89,6 +127,37 @@ def dataframe_to_covjson(df: pd.DataFrame, metadata: dict):
     return covjson
 
 
+# numpy arrays are serialized natively, naive datetimes are UTC and formatted with a trailing "Z"
+JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+
+# Arrow types for the ERDDAP data types, so that pyarrow doesn't have to guess them from the values (e.g. a String
+# variable with only digits)
+ERDDAP_ARROW_TYPES = {
+    "String": pyarrow.string(),
+    "char": pyarrow.string(),
+    "double": pyarrow.float64(),
+    "float": pyarrow.float64(),
+    "byte": pyarrow.int64(),
+    "ubyte": pyarrow.int64(),
+    "short": pyarrow.int64(),
+    "ushort": pyarrow.int64(),
+    "int": pyarrow.int64(),
+    "uint": pyarrow.int64(),
+    "long": pyarrow.int64(),
+    "ulong": pyarrow.uint64(),
+}
+
+
+def json_default(obj):
+    """
+    Fallback for objects that orjson can't serialize natively, such as non-contiguous or object numpy arrays
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
 class ErddapDownloader():
     def __init__(self, url, erddap_url):
 
@@ -98,65 +167,133 @@ class ErddapDownloader():
         self.dataset_dict = {}
         self.dataset_dict_t = None
         self.cache_time = 3600
+        self._lock = threading.Lock()
+        self._first_lock = threading.Lock()
+        self._refreshing = False
+        # Keep connections to ERDDAP alive across requests. Metadata requests go through an on-disk HTTP cache,
+        # data requests are never cached
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=3)
+        self.session = requests.Session()
+        self.meta_session = requests_cache.CachedSession("erddap_cache.sqlite", expire_after=self.cache_time,
+                                                         cache_control=True)
+        for session in (self.session, self.meta_session):
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+    def _refresh(self):
+        """
+        Downloads the dataset list and swaps it with the current one
+        """
+        try:
+            search_url = self.e.get_search_url(response='json', search_for='all')
+            rich.print("Refreshing dataset list")
+            table = self.session.get(search_url, timeout=30).json()["table"]
+            idx_dsid = table["columnNames"].index("Dataset ID")
+            dataset_dict = {r[idx_dsid]: self.url + f"/{r[idx_dsid]}" for r in table["rows"][1:]}
+            with self._lock:
+                self.dataset_dict = dataset_dict
+                self.dataset_dict_t = time.time()
+        finally:
+            with self._lock:
+                self._refreshing = False
 
     def get_dataset_dict(self):
-        if not self.dataset_dict_t or (time.time() - self.dataset_dict_t) > self.cache_time:
-            all_datasets = self.e.get_search_url(response='csv', search_for='all')
-            rich.print("Refreshing dataset list")
-            df = pd.read_csv(all_datasets)
-            dataset_dict = {dataset_id: self.url + f"/{dataset_id}" for dataset_id in df["Dataset ID"].loc[1:]}
-            self.dataset_dict = dataset_dict
+        """
+        Returns the dataset list. Once the cache expires the stale list is still returned while a background
+        thread downloads the new one, so requests never wait for ERDDAP except for the very first one.
+        """
+        with self._lock:
+            first = self.dataset_dict_t is None
+            stale = first or (time.time() - self.dataset_dict_t) > self.cache_time
+            background = stale and not first and not self._refreshing
+            if background:
+                self._refreshing = True
+
+        if first:
+            # Nothing to serve yet, refresh synchronously. Concurrent callers wait for the first one instead of
+            # downloading the list again
+            with self._first_lock:
+                if self.dataset_dict_t is None:
+                    self._refresh()
+        elif background:
+            threading.Thread(target=self._refresh, daemon=True).start()
         return self.dataset_dict
 
     def get_data(self, dataset_id, params) -> (dict, int):
-        url = self.errdap_url + f"/tabledap/{dataset_id}.json" + "?" + params
-
-        rich.print(f"[cyan]Getting data from {url}")
         t = time.time()
-        resp = requests.get(url)
-        data = resp.json()
-        columns = data["table"]["columnNames"]
 
-        rows = data["table"]["rows"]
-        data = pd.DataFrame(rows, columns=columns)
-        print(data)
-
-        # Now accessing metadata
+        # Metadata goes first, the declared data types are needed to parse the data
         url = self.errdap_url + f"/info/{dataset_id}/index.json"
-        resp = requests.get(url)
-        meta = resp.json()
+        resp = self.meta_session.get(url, timeout=30)
+        if resp.status_code > 399:
+            rich.print(f"[red]HTTP CODE: {resp.status_code}")
+            rich.print(f"[red]HTTP ERROR: {resp.text}")
+            return {"error": resp.text}, resp.status_code
+        meta = orjson.loads(resp.content)
         columns = meta["table"]["columnNames"]
         rows = meta["table"]["rows"]
         meta = pd.DataFrame(rows, columns=columns)
-        get_data_msecs = 1000*(time.time() - t)
 
+        # Pivot the metadata table into {variable: {attribute: value}} once, instead of filtering it for every column
+        meta_map = {}
+        for varname, attr_name, value in zip(meta["Variable Name"], meta["Attribute Name"], meta["Value"]):
+            meta_map.setdefault(varname, {}).setdefault(attr_name, value)
+
+        def get_value_from_meta(varname, attr_name, alternative=""):
+            return meta_map.get(varname, {}).get(attr_name, str(alternative))
+
+        variables = meta.loc[meta["Row Type"] == "variable"]
+        column_types = {}
+        for varname, data_type in zip(variables["Variable Name"], variables["Data Type"]):
+            if varname == "time":
+                continue  # the only variable parsed as a timestamp
+            elif " since " in get_value_from_meta(varname, "units"):
+                # other time variables are written as ISO strings, keep them as they are
+                column_types[varname] = pyarrow.string()
+            elif data_type in ERDDAP_ARROW_TYPES:
+                column_types[varname] = ERDDAP_ARROW_TYPES[data_type]
+
+        url = self.errdap_url + f"/tabledap/{dataset_id}.csvp" + "?" + params
+        rich.print(f"[cyan]Getting data from {url}")
+        resp = self.session.get(url, stream=True, timeout=30)
+        if resp.status_code > 399:
+            rich.print(f"[red]HTTP CODE: {resp.status_code}")
+            rich.print(f"[red]HTTP ERROR: {resp.text}")
+            return {"error": resp.text}, resp.status_code
 
-        names_and_units = {}
+        # Parse the CSV stream straight into an arrow table, no intermediate python rows
+        resp.raw.decode_content = True
+        # csvp headers look like "name (units)", keep only the variable name
+        header = next(csv.reader([resp.raw.readline().decode()]))
+        names = [c.split(" (", 1)[0] for c in header]
+        table = pyarrow.csv.read_csv(
+            resp.raw,
+            read_options=pyarrow.csv.ReadOptions(block_size=8 << 20, column_names=names),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types={n: column_types[n] for n in names if n in column_types}
+            )
+        )
+        # nullable integer dtypes, otherwise integer columns with missing values would be converted to float
+        data = table.to_pandas(types_mapper={
+            pyarrow.int64(): pd.Int64Dtype(),
+            pyarrow.uint64(): pd.UInt64Dtype(),
+        }.get)
+        get_data_msecs = 1000*(time.time() - t)
 
-        def get_value_from_meta(df, varname, attr_name, alternative=""):
-            df = df[df["Variable Name"] == varname]
-            row = df[df["Attribute Name"] == attr_name]
-            if row.empty:
-                return str(alternative)
-            else:
-                return row["Value"].values[0]
+        names_and_units = {}
 
         for c in data.columns:
-            definition = get_value_from_meta(meta, c, "sdn_parameter_urn", alternative="")
+            definition = get_value_from_meta(c, "sdn_parameter_urn", alternative="")
             if definition:
                 _, vocab, _, term = definition.split(":")
                 definition = f"http://vocab.nerc.ac.uk/collection/{vocab}/current/{term}/"
 
             names_and_units[c] = {
-                "name": get_value_from_meta(meta, c, "standard_name", alternative=c),
-                "units": get_value_from_meta(meta, c, "units"),
+                "name": get_value_from_meta(c, "standard_name", alternative=c),
+                "units": get_value_from_meta(c, "units"),
                 "definition": definition
             }
 
-        if resp.status_code > 399:
-            rich.print(f"[red]HTTP CODE: {resp.status_code}")
-            rich.print(f"[red]HTTP ERROR: {resp.text}")
-            return {"error": resp.text}, resp.status_code
         t = time.time()
         data = dataframe_to_covjson(data, names_and_units)
         rich.print(f"[cyan]   getting data took {get_data_msecs:.02f} msecs")
@@ -223,12 +360,12 @@ def geo2coverage_help():
     document = {
         "message": "it works!"
     }
-    return Response(json.dumps(document), status=200, mimetype="application/json")
+    return Response(orjson.dumps(document, option=JSON_OPTIONS, default=json_default), status=200, mimetype="application/json")
 
 @app.route('/geo2coverage/v1.0/datasets', methods=['GET'])
 def geo2coverage_datasets():
     document = app.erddap.get_dataset_dict()
-    return Response(json.dumps(document), status=200, mimetype="application/json")
+    return Response(orjson.dumps(document, option=JSON_OPTIONS, default=json_default), status=200, mimetype="application/json")
 
 @app.route('/geo2coverage/v1.0/<dataset_id>', methods=['GET'])
 def geo2coverage_data(dataset_id):
@@ -239,7 +376,25 @@ def geo2coverage_data(dataset_id):
     else:
         opts = request.url.split("?")[1]
     data, code = app.erddap.get_data(dataset_id, params=opts)
-    return Response(json.dumps(data), status=code, mimetype="application/json")
+    return Response(orjson.dumps(data, option=JSON_OPTIONS, default=json_default), status=code, mimetype="application/json")
+
+
+process = psutil.Process(os.getpid())
+metrics = {"t": None, "document": {}}
+
+
+@app.route('/metrics', methods=['GET'])
+def geo2coverage_metrics():
+    # psutil is only sampled once per second, scrapes in between get the last sample
+    now = time.monotonic()
+    if metrics["t"] is None or now - metrics["t"] > 1:
+        metrics["document"] = {
+            "cpu": process.cpu_percent(interval=None),  # usage since the previous sample
+            "rss_mb": process.memory_info().rss / 2**20
+        }
+        metrics["t"] = now
+    return Response(orjson.dumps(metrics["document"]), status=200, mimetype="application/json")
+
 
 # 3. Function to list all endpoints
 def list_endpoints():
@@ -264,15 +419,6 @@ def list_endpoints():
         print(f"Endpoint: {item['endpoint']:<15} | Methods: {item['methods']:<10} | Path: {item['path']}")
     print("-------------------------------")
 
-def show_usage():
-    process = psutil.Process(os.getpid())
-    while True:
-        cpu = process.cpu_percent(interval=1)
-        mem = process.memory_info().rss / (1024 ** 2)  # MB
-        rich.print(f"[cyan] CPU: {cpu}% | RAM: {mem:.2f} MB")
-        time.sleep(1)
-
-
 if __name__ == "__main__":
     argparser = ArgumentParser()
     argparser.add_argument("-e", "--erddap-url", help="ERDDAP URL to download data", type=str, default="https://erddap.emso.eu/erddap")
@@ -282,8 +428,6 @@ if __name__ == "__main__":
     args = argparser.parse_args()
 
     log = setup_log("Setting UP API")
-    t = threading.Thread(target=show_usage, daemon=True)
-    t.start()
 
     erddap = ErddapDownloader(args.url, args.erddap_url)
     app.erddap = erddap
@@ -0,0 +1,84 @@
+from unittest import mock
+
+import create_ttls
+
+
+def session_with(dataset_ids):
+    session = mock.MagicMock()
+    session.get.return_value.json.return_value = {"table": {
+        "columnNames": ["griddap", "tabledap", "Dataset ID"],
+        "rows": [["", f"http://erddap/tabledap/{i}", i] for i in dataset_ids]
+    }}
+    return session
+
+
+def test_get_erddap_metadata_cache(tmp_path):
+    session = session_with(["a", "b"])
+    df = create_ttls.get_erddap_metadata(session, "http://erddap-1/erddap", cache_folder=tmp_path)
+    assert df["Dataset ID"].tolist() == ["a", "b"]
+
+    # Second call is served from the Parquet file
+    df = create_ttls.get_erddap_metadata(session, "http://erddap-1/erddap/", cache_folder=tmp_path)
+    assert df["Dataset ID"].tolist() == ["a", "b"]
+    assert session.get.call_count == 1
+
+
+def test_get_erddap_metadata_cache_per_server(tmp_path):
+    create_ttls.get_erddap_metadata(session_with(["a", "b"]), "http://erddap-1/erddap", cache_folder=tmp_path)
+    df = create_ttls.get_erddap_metadata(session_with(["c"]), "http://erddap-2/erddap", cache_folder=tmp_path)
+    assert df["Dataset ID"].tolist() == ["c"]
+    assert len(list(tmp_path.glob("erddap_index_*.parquet"))) == 2
+
+
+GLOBAL_ATTRIBUTES = {
+    "institution": "UPC",
+    "title": "OBSEA CTD",
+    "summary": "CTD data from OBSEA",
+    "license_uri": "https://spdx.org/licenses/CC-BY-4.0",
+    "keywords": "temperature",
+    "time_coverage_start": "2020-01-01T00:00:00Z",
+    "geospatial_lat_max": "41.18",
+    "geospatial_lon_max": "1.75",
+    "emso_facility": "OBSEA",
+}
+
+
+def dataset_metadata(**global_attributes):
+    attributes = {**GLOBAL_ATTRIBUTES, **global_attributes}
+    rows = [["attribute", "NC_GLOBAL", name, "String", value] for name, value in attributes.items()
+            if value is not None]
+    rows += [
+        ["variable", "time", "", "double", ""],
+        ["attribute", "time", "actual_range", "double", "1.5778368E9, 1.6094592E9"],
+        ["variable", "TEMP", "", "float", ""],
+        ["attribute", "TEMP", "standard_name", "String", "sea_water_temperature"],
+    ]
+    return create_ttls.pd.DataFrame(rows, columns=["Row Type", "Variable Name", "Attribute Name", "Data Type",
+                                                   "Value"])
+
+
+def test_ttl_from_erddap(tmp_path):
+    assert create_ttls.ttl_from_erddap(dataset_metadata(), "OBSEA_CTD", "http://converter", tmp_path)
+    contents = (tmp_path / "OBSEA_CTD.ttl").read_text()
+    assert 'schema:legalName "UPC"' in contents
+    assert "<category:OBSEA_conc>" in contents
+    assert (tmp_path / "0_OBSEA.ttl").exists()
+
+
+def test_ttl_from_erddap_missing_attribute(tmp_path):
+    df = dataset_metadata(license_uri=None)
+    assert create_ttls.ttl_from_erddap(df, "OBSEA_CTD", "http://converter", tmp_path) is False
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_ttl_from_erddap_missing_facility(tmp_path):
+    df = dataset_metadata(emso_facility=None)
+    assert create_ttls.ttl_from_erddap(df, "OBSEA_CTD", "http://converter", tmp_path) is False
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_ttl_from_erddap_facility_fallback(tmp_path):
+    df = dataset_metadata(emso_facility=None)
+    assert create_ttls.ttl_from_erddap(df, "SmartBay_CTD", "http://converter", tmp_path)
+    assert (tmp_path / "SmartBay_CTD.ttl").exists()
+    assert (tmp_path / "0_SmartBay.ttl").exists()
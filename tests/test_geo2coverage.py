@@ -0,0 +1,218 @@
+import io
+import orjson
+import pytest
+import threading
+import time
+from unittest import mock
+
+import geo2coverage
+
+DATA_CSVP = (b"time (UTC),latitude (degrees_north),longitude (degrees_east),TEMP (degree_C)\n"
+             b"2020-01-01T00:00:00Z,41.1,2.0,12.5\n"
+             b"2020-01-01T01:00:00Z,41.1,2.0,NaN\n")
+
+META = {"table": {
+    "columnNames": ["Row Type", "Variable Name", "Attribute Name", "Data Type", "Value"],
+    "rows": [
+        ["variable", "time", "", "double", ""],
+        ["attribute", "time", "units", "String", "seconds since 1970-01-01T00:00:00Z"],
+        ["variable", "TEMP", "", "float", ""],
+        ["attribute", "TEMP", "standard_name", "String", "sea_water_temperature"],
+        ["attribute", "TEMP", "units", "String", "degree_C"],
+        ["attribute", "TEMP", "sdn_parameter_urn", "String", "SDN:P01::TEMPPR01"],
+    ]
+}}
+
+
+def response(status_code=200, raw=b"", content=b"", text=""):
+    resp = mock.MagicMock()
+    resp.status_code = status_code
+    resp.raw = io.BytesIO(raw)
+    resp.content = content
+    resp.text = text
+    return resp
+
+
+@pytest.fixture
+def downloader(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)  # keep the requests-cache database out of the repo
+    monkeypatch.setattr(geo2coverage.erddapy, "ERDDAP", mock.MagicMock())
+    erddap = geo2coverage.ErddapDownloader("http://localhost:5000/geo2coverage/v1.0", "http://erddap")
+    erddap.session = mock.MagicMock()
+    erddap.meta_session = mock.MagicMock()
+    erddap.session.get.return_value = response(raw=DATA_CSVP)
+    erddap.meta_session.get.return_value = response(content=orjson.dumps(META))
+    return erddap
+
+
+def test_get_data(downloader):
+    covjson, code = downloader.get_data("dataset", "time,TEMP")
+    assert code == 200
+    document = orjson.loads(orjson.dumps(covjson, option=geo2coverage.JSON_OPTIONS,
+                                         default=geo2coverage.json_default))
+    assert document["domain"]["axes"]["t"]["values"] == ["2020-01-01T00:00:00Z", "2020-01-01T01:00:00Z"]
+    assert document["ranges"]["TEMP"]["values"] == [12.5, None]
+    assert document["parameters"]["TEMP"]["observedProperty"]["id"] == \
+           "http://vocab.nerc.ac.uk/collection/P01/current/TEMPPR01/"
+
+
+def test_get_data_metadata_error(downloader):
+    downloader.meta_session.get.return_value = response(status_code=404, content=b"<html>Not Found</html>",
+                                                        text="Not Found")
+    covjson, code = downloader.get_data("dataset", "time,TEMP")
+    assert code == 404
+    assert covjson == {"error": "Not Found"}
+
+
+def test_get_data_string_parameter(downloader):
+    downloader.session.get.return_value = response(raw=(
+        b"time (UTC),latitude (degrees_north),longitude (degrees_east),TEMP (degree_C),sensor_id\n"
+        b"2020-01-01T00:00:00Z,41.1,2.0,12.5,SBE37\n"
+        b"2020-01-01T01:00:00Z,41.1,2.0,NaN,SBE37\n"))
+    covjson, code = downloader.get_data("dataset", "time,TEMP,sensor_id")
+    assert code == 200
+    document = orjson.loads(orjson.dumps(covjson, option=geo2coverage.JSON_OPTIONS,
+                                         default=geo2coverage.json_default))
+    assert document["ranges"]["TEMP"]["dataType"] == "float"
+    assert document["ranges"]["TEMP"]["values"] == [12.5, None]
+    assert document["ranges"]["sensor_id"]["dataType"] == "string"
+    assert document["ranges"]["sensor_id"]["values"] == ["SBE37", "SBE37"]
+
+
+def test_get_data_float32_only_floats(downloader):
+    meta = {"table": {"columnNames": META["table"]["columnNames"], "rows": META["table"]["rows"] + [
+        ["variable", "TEMP_QC", "", "byte", ""],
+        ["variable", "counter", "", "long", ""],
+        ["variable", "platform_code", "", "String", ""],
+    ]}}
+    downloader.meta_session.get.return_value = response(content=orjson.dumps(meta))
+    downloader.session.get.return_value = response(raw=(
+        b"time (UTC),latitude (degrees_north),longitude (degrees_east),TEMP (degree_C),TEMP_QC,counter,"
+        b"platform_code\n"
+        b"2020-01-01T00:00:00Z,41.1,2.0,12.345678901,1,16777217,OBSEA\n"
+        b"2020-01-01T01:00:00Z,41.1,2.0,13,,16777218,00123\n"))
+    covjson, code = downloader.get_data("dataset", "time,TEMP,TEMP_QC,counter,platform_code")
+    assert code == 200
+    ranges = covjson["ranges"]
+    assert ranges["TEMP"]["values"].dtype == geo2coverage.np.float32
+    document = orjson.loads(orjson.dumps(covjson, option=geo2coverage.JSON_OPTIONS,
+                                         default=geo2coverage.json_default))
+    ranges = document["ranges"]
+    assert ranges["TEMP"]["dataType"] == "float"
+    assert ranges["TEMP"]["values"] == [12.345679, 13.0]
+    # integers are kept exact, also with missing values
+    assert ranges["TEMP_QC"]["dataType"] == "integer"
+    assert ranges["TEMP_QC"]["values"] == [1, None]
+    assert ranges["counter"]["dataType"] == "integer"
+    assert ranges["counter"]["values"] == [16777217, 16777218]
+    # strings are never converted, leading zeros are preserved
+    assert ranges["platform_code"]["dataType"] == "string"
+    assert ranges["platform_code"]["values"] == ["OBSEA", "00123"]
+
+
+def test_get_data_declared_types(downloader):
+    meta = {"table": {"columnNames": META["table"]["columnNames"], "rows": META["table"]["rows"] + [
+        ["variable", "platform_code", "", "String", ""],
+        ["variable", "deploy_time", "", "String", ""],
+        ["variable", "recovery_time", "", "double", ""],
+        ["attribute", "recovery_time", "units", "String", "seconds since 1970-01-01T00:00:00Z"],
+    ]}}
+    downloader.meta_session.get.return_value = response(content=orjson.dumps(meta))
+    downloader.session.get.return_value = response(raw=(
+        b"time (UTC),latitude (degrees_north),longitude (degrees_east),platform_code,deploy_time,"
+        b"recovery_time (UTC)\n"
+        b"2020-01-01T00:00:00Z,41.1,2.0,00123,2019-06-01T00:00:00Z,2021-06-01T00:00:00Z\n"
+        b"2020-01-01T01:00:00Z,41.1,2.0,00123,2019-06-01T00:00:00Z,2021-06-01T00:00:00Z\n"))
+    covjson, code = downloader.get_data("dataset", "time,platform_code,deploy_time,recovery_time")
+    assert code == 200
+    document = orjson.loads(orjson.dumps(covjson, option=geo2coverage.JSON_OPTIONS,
+                                         default=geo2coverage.json_default))
+    assert document["domain"]["axes"]["t"]["values"] == ["2020-01-01T00:00:00Z", "2020-01-01T01:00:00Z"]
+    assert document["ranges"]["platform_code"]["dataType"] == "string"
+    assert document["ranges"]["platform_code"]["values"] == ["00123", "00123"]
+    assert document["ranges"]["deploy_time"]["values"] == ["2019-06-01T00:00:00Z"] * 2
+    assert document["ranges"]["recovery_time"]["values"] == ["2021-06-01T00:00:00Z"] * 2
+
+
+def slow_search(rows, delay=0.1):
+    def get(*args, **kwargs):
+        time.sleep(delay)
+        resp = mock.MagicMock()
+        resp.json.return_value = {"table": {"columnNames": ["griddap", "Dataset ID"], "rows": rows}}
+        return resp
+    return get
+
+
+def test_get_dataset_dict_first_load_once(downloader):
+    downloader.session.get.side_effect = slow_search([["", "allDatasets"], ["", "a"]])
+    threads = [threading.Thread(target=downloader.get_dataset_dict) for _ in range(8)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert downloader.session.get.call_count == 1
+    assert downloader.get_dataset_dict() == {"a": "http://localhost:5000/geo2coverage/v1.0/a"}
+
+
+def test_get_dataset_dict_background_refresh(downloader):
+    downloader.session.get.side_effect = slow_search([["", "allDatasets"], ["", "a"]], delay=0)
+    downloader.get_dataset_dict()
+    downloader.dataset_dict_t -= downloader.cache_time + 1
+    downloader.session.get.side_effect = slow_search([["", "allDatasets"], ["", "a"], ["", "b"]])
+
+    # stale list is returned at once, only one refresh is started
+    t = time.time()
+    assert list(downloader.get_dataset_dict()) == ["a"]
+    assert list(downloader.get_dataset_dict()) == ["a"]
+    assert time.time() - t < 0.1
+    time.sleep(0.3)
+    assert list(downloader.get_dataset_dict()) == ["a", "b"]
+    assert downloader.session.get.call_count == 2
+
+
+def test_get_data_extra_time_column(downloader):
+    meta = {"table": {"columnNames": META["table"]["columnNames"], "rows": META["table"]["rows"] + [
+        ["variable", "platform_code", "", "String", ""],
+    ]}}
+    downloader.meta_session.get.return_value = response(content=orjson.dumps(meta))
+    # deploy_time is not declared in the metadata, so pyarrow parses it as a timestamp
+    downloader.session.get.return_value = response(raw=(
+        b"time (UTC),latitude (degrees_north),longitude (degrees_east),platform_code,deploy_time\n"
+        b"2020-01-01T00:00:00Z,41.1,2.0,00123,2019-06-01T00:00:00Z\n"
+        b"2020-01-01T01:00:00Z,41.1,2.0,00123,\n"))
+    covjson, code = downloader.get_data("dataset", "time,platform_code,deploy_time")
+    assert code == 200
+    document = orjson.loads(orjson.dumps(covjson, option=geo2coverage.JSON_OPTIONS,
+                                         default=geo2coverage.json_default))
+    assert document["ranges"]["platform_code"]["values"] == ["00123", "00123"]
+    assert document["ranges"]["deploy_time"]["dataType"] == "string"
+    assert document["ranges"]["deploy_time"]["values"] == ["2019-06-01T00:00:00Z", None]
+
+
+def test_get_data_missing_time(downloader):
+    downloader.session.get.return_value = response(raw=(
+        b"time (UTC),latitude (degrees_north),longitude (degrees_east),TEMP (degree_C)\n"
+        b"2020-01-01T00:00:00Z,41.1,2.0,12.5\n"
+        b",41.1,2.0,13.5\n"))
+    covjson, code = downloader.get_data("dataset", "time,TEMP")
+    assert code == 200
+    document = orjson.loads(orjson.dumps(covjson, option=geo2coverage.JSON_OPTIONS,
+                                         default=geo2coverage.json_default))
+    assert document["domain"]["axes"]["t"]["values"] == ["2020-01-01T00:00:00Z"]
+    assert document["ranges"]["TEMP"]["values"] == [12.5]
+    assert document["ranges"]["TEMP"]["shape"] == [1]
+
+
+def test_metrics(monkeypatch):
+    process = mock.MagicMock()
+    process.cpu_percent.return_value = 12.5
+    process.memory_info.return_value.rss = 64 * 2**20
+    monkeypatch.setattr(geo2coverage, "process", process)
+    monkeypatch.setattr(geo2coverage, "metrics", {"t": None, "document": {}})
+    client = geo2coverage.app.test_client()
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert orjson.loads(resp.data) == {"cpu": 12.5, "rss_mb": 64.0}
+    # scrapes within the cooldown reuse the last sample
+    client.get("/metrics")
+    assert process.cpu_percent.call_count == 1
+    process.cpu_percent.assert_called_with(interval=None)